@@ -23,19 +23,34 @@
 import click
 import subprocess
 import xml.etree.ElementTree as et
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import typing as T
 import os
 import sys
 import enum
 import re
-import copy
-from time import sleep, time
+import concurrent.futures
+import tempfile
+import io
+import queue
+import threading
+import collections
+from time import time
 
 GREEN = '\033[92m'
 RED = '\033[91m'
 BLUE = '\033[94m'
 END_COLOR = '\033[0m'
+ANSI_ESCAPE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+# Test counter at the start of a result line in the test log, e.g. '3/10 "test name" [tag] OK   0.123s'
+TEST_COUNTER = re.compile(r'\d+/\d+')
+
+# Maximum number of lines waiting to be written to the test log
+LOG_QUEUE_SIZE = 1024
+# Size of the test log write buffer, the log is flushed when full and at exit
+LOG_BUFFER_SIZE = 1 << 20
+# Interval for refreshing the run status line while waiting for tests to finish
+RUN_STATUS_INTERVAL = 0.2
 
 
 @dataclass
@@ -44,6 +59,9 @@ class TestCase:
     tags: str
     name_and_tag: str = ""
     test_process: subprocess.Popen = None
+    output: bytes = b""
+    errors: bytes = b""
+    duration: float = -1
 
 
 @dataclass
@@ -51,51 +69,84 @@ class TestPrinter:
     max_test_name_length = 0
     test_counter = 0
     test_count = 0
+    test_count_width = 0
     ok_count = 0
     failing_count = 0
     verbose = False
     quiet = False
     run_status_idx = 0
+    run_status_counter = -1
+    run_status_prefix = ""
     test_log = None
+    log_queue = None
+    log_writer = None
+    log_error = None
+    failing_tests: T.List[str] = field(default_factory=list)
+
+    def print_result(self, test_cases: T.List[TestCase]):
+        # Tests run by the same process share its status and output
+        test_process = test_cases[0].test_process
+        status = test_process.poll()
+        stdout_lines = test_cases[0].output.decode(errors='replace').splitlines()
+        stderr_lines = test_cases[0].errors.decode(errors='replace').splitlines()
 
-    def print_result(self, test_case: TestCase):
-        self.test_counter += 1
-
-        status = test_case.test_process.poll()
-        # Find line with "===============", previous line has duration
-        stdout_lines = test_case.test_process.stdout.readlines()
-        stderr_lines = test_case.test_process.stderr.readlines()
-        line = len(stdout_lines) - 1
-        duration = -1
-        while duration < 0 and line > 0:
-            if "=====" in stdout_lines[line]:
-                duration = float(stdout_lines[line - 1].split(" s:")[0])
-            line -= 1
-
-        test_count_print = f"{self.test_counter}/{self.test_count}"
-        test_count_print_len = 2*len(str(self.test_count)) + 1
+        for test_case in test_cases:
+            # Output is not needed after it has been logged, the test cases are kept until exit
+            test_case.output = b""
+            test_case.errors = b""
+            self.test_counter += 1
+            test_count_print = f"{self.test_counter}/{self.test_count}"
+            duration = test_case.duration
+            if status == 0:
+                self.ok_count += 1
+                self.log(f"{test_count_print:{self.test_count_width}} {test_case.name_and_tag:{self.max_test_name_length}} {GREEN}OK{END_COLOR}   {duration:3.3f}s",
+                         print_condition=not (self.quiet))
+            else:
+                self.failing_count += 1
+                self.failing_tests.append(f"\"{test_case.name}\" {test_case.tags}")
+                self.log(f"{test_count_print:{self.test_count_width}} {test_case.name_and_tag:{self.max_test_name_length}} {RED}FAIL{END_COLOR} {duration:3.3f}s")
         if status == 0:
-            self.ok_count += 1
-            self.log(f"{test_count_print:{test_count_print_len}} {test_case.name_and_tag:{self.max_test_name_length}} {GREEN}OK{END_COLOR}   {duration:3.3f}s",
-                     print_condition=not (self.quiet))
-            self.log("".join(stdout_lines).strip(), self.verbose)
+            self.log("\n".join(stdout_lines).strip(), self.verbose)
         else:
-            self.failing_count += 1
-            self.log(f"{test_count_print:{test_count_print_len}} {test_case.name_and_tag:{self.max_test_name_length}} {RED}FAIL{END_COLOR} {duration:3.3f}s")
-            self.log("".join(stdout_lines).strip())
+            self.log("\n".join(stdout_lines).strip())
             self.log()
         if len(stderr_lines) != 0:
             # Print stderr by default even for passing cases
             self.log(f"{BLUE}stderr:{END_COLOR}", print_condition=not self.quiet)
-            self.log("".join(stderr_lines).strip(), print_condition=not self.quiet)
+            self.log("\n".join(stderr_lines).strip(), print_condition=not self.quiet)
+
+    def print_failed_batch(self, test_cases: T.List[TestCase]):
+        # The tests are rerun one by one to find which of them failed but the output of the batch
+        # is logged in case the failure does not happen when they are run alone
+        test_names = ", ".join(f"\"{test_case.name}\"" for test_case in test_cases)
+        self.log(f"{BLUE}Batch failed, rerunning tests one by one:{END_COLOR} {test_names}")
+        self.log(test_cases[0].output.decode(errors='replace').strip())
+        errors = test_cases[0].errors.decode(errors='replace').strip()
+        if len(errors) != 0:
+            self.log(f"{BLUE}stderr:{END_COLOR}")
+            self.log(errors)
+        self.log()
+        for test_case in test_cases:
+            test_case.output = b""
+            test_case.errors = b""
+
+    def print_batch_failure(self, test_cases: T.List[TestCase]):
+        # Tests of a failed batch passed when run alone so they depend on each other
+        test_names = ", ".join(f"\"{test_case.name}\"" for test_case in test_cases)
+        self.failing_count += 1
+        self.failing_tests.append(f"Batch of {len(test_cases)} tests: {test_names}")
+        self.log(f"{RED}FAIL{END_COLOR} Tests passed when run alone but failed when run in the same process: {test_names}")
+        self.log()
 
     def print_run_status(self, running_tests: T.List[TestCase]):
-        test_count_print = f"{self.test_counter}/{self.test_count}"
-        test_count_print_len = 2*len(str(self.test_count)) + 1
+        # Prefix only changes when a test finishes
+        if self.run_status_counter != self.test_counter:
+            test_count_print = f"{self.test_counter}/{self.test_count}"
+            self.run_status_prefix = f"{BLUE}Running {test_count_print:{self.test_count_width}}{END_COLOR}"
+            self.run_status_counter = self.test_counter
         self.run_status_idx = (self.run_status_idx + 1) % (len(running_tests))
         self.log('\x1b[K', end="\r")
-        self.log(
-            f"{BLUE}Running {test_count_print:{test_count_print_len}}{END_COLOR} {running_tests[self.run_status_idx].name_and_tag}", end="\r")
+        self.log(f"{self.run_status_prefix} {running_tests[self.run_status_idx].name_and_tag}", end="\r")
 
     def log(self, s: str = '',
             print_condition: bool = True,
@@ -103,9 +154,187 @@ class TestPrinter:
         if print_condition:
             print(s, end=end)
         if end == "\n":
-            ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-            s = ansi_escape.sub('', s)
-            self.test_log.write(s + '\n')
+            # Most lines have no colors, skip the regex for them
+            if '\x1b' in s:
+                s = ANSI_ESCAPE.sub('', s)
+            self.log_queue.put(s)
+
+    def open_log(self, path: str):
+        # Lines are written to the log file in a background thread so that a slow disk does not
+        # hold up running the tests
+        self.test_log = open(path, 'wb', buffering=LOG_BUFFER_SIZE)
+        self.log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.log_writer = threading.Thread(target=self.write_log, daemon=True)
+        self.log_writer.start()
+
+    def close_log(self):
+        self.log_queue.put(None)
+        self.log_writer.join()
+        try:
+            self.test_log.close()
+        except OSError as e:
+            self.report_log_error(e)
+
+    def write_log(self):
+        for s in iter(self.log_queue.get, None):
+            if self.log_error is not None:
+                # Keep emptying the queue so that logging never blocks running the tests
+                continue
+            try:
+                self.test_log.write(s.encode('utf-8'))
+                self.test_log.write(b'\n')
+            except Exception as e:
+                self.report_log_error(e)
+
+    def report_log_error(self, e: Exception):
+        if self.log_error is None:
+            self.log_error = e
+            print(f"\n{RED}Writing test log failed: {e}{END_COLOR}", file=sys.stderr)
+
+
+def read_previous_durations(log: str) -> T.Dict[str, float]:
+    # Durations of the tests by name and tag from the test log of the previous run
+    durations = {}
+    try:
+        with open(log, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                # The log also has the output of the tests, skip lines not starting with the counter
+                if not line[:1].isdigit():
+                    continue
+                fields = line.rsplit(None, 2)
+                if len(fields) != 3 or fields[1] not in ('OK', 'FAIL') or not fields[2].endswith('s'):
+                    continue
+                counter_and_name = fields[0].split(None, 1)
+                if len(counter_and_name) != 2 or not TEST_COUNTER.fullmatch(counter_and_name[0]):
+                    continue
+                name_and_tag, duration = counter_and_name[1], fields[2]
+                try:
+                    duration = float(duration[:-1])
+                except ValueError:
+                    continue
+                durations[name_and_tag] = max(durations.get(name_and_tag, 0.0), duration)
+    except OSError:
+        pass
+    return durations
+
+
+def read_durations(results_file: str) -> T.Dict[str, float]:
+    # Durations of the test cases from Catch2 XML report. The report is incomplete if the test
+    # process crashed so durations are returned for the test cases that finished.
+    durations = {}
+    try:
+        for _, element in et.iterparse(results_file, events=('end',)):
+            if element.tag != 'TestCase':
+                continue
+            # Test cases without a duration fall back to parsing the console output
+            result = element.find('OverallResult')
+            duration = result.get('durationInSeconds') if result is not None else None
+            if duration is not None:
+                try:
+                    durations[element.get('name')] = float(duration)
+                except ValueError:
+                    pass
+            element.clear()
+    except (OSError, et.ParseError):
+        pass
+    return durations
+
+
+def parse_duration(output: bytes, test_name: str) -> float:
+    # Catch2 prints line "<duration> s: <test name>" when the test case ends
+    name = b" s: " + test_name.encode()
+    line_end = max(output.rfind(name + b"\n"), output.rfind(name + b"\r\n"))
+    if line_end < 0:
+        return -1
+    line_start = output.rfind(b"\n", 0, line_end) + 1
+    try:
+        return float(output[line_start:line_end])
+    except ValueError:
+        return -1
+
+
+def split_to_batches(test_cases: T.List[TestCase], batch_size: int) -> T.List[T.List[TestCase]]:
+    # Catch2 runs a test only once per process even if it is listed several times so repeats of
+    # the same test go to different batches
+    batches: T.List[T.List[TestCase]] = []
+    batch_names = set()
+    for test_case in test_cases:
+        if len(batches) == 0 or len(batches[-1]) == batch_size or test_case.name in batch_names:
+            batches.append([])
+            batch_names = set()
+        batches[-1].append(test_case)
+        batch_names.add(test_case.name)
+    return batches
+
+
+def start_tests(test_exe: str, test_cases: T.List[TestCase], quiet: bool):
+    test_names_file = None
+    if len(test_cases) == 1:
+        test_args = [test_cases[0].name]
+    else:
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.txt', delete=False) as f:
+            f.writelines(f"{test_case.name}\n" for test_case in test_cases)
+        test_names_file = f.name
+        test_args = ['--input-file', test_names_file]
+    with tempfile.NamedTemporaryFile(suffix='.xml', delete=False) as f:
+        results_file = f.name
+    if quiet:
+        # Output is not printed while running so let the test write it to temporary files
+        # instead of waking up the reader thread for every pipe write
+        stdout, stderr = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+    else:
+        stdout, stderr = subprocess.PIPE, subprocess.PIPE
+    # Console output is shown to the user, durations are read from the XML report
+    test_process = subprocess.Popen([test_exe, *test_args, '--colour-mode=ansi', '--durations=yes',
+                                     '--reporter', 'console', '--reporter', f'xml::out={results_file}'],
+                                    stdout=stdout,
+                                    stderr=stderr)
+    for test_case in test_cases:
+        test_case.test_process = test_process
+    return stdout, stderr, test_names_file, results_file
+
+
+def read_output_file(output_file) -> bytes:
+    with output_file:
+        output_file.seek(0)
+        return output_file.read()
+
+
+def run_tests_process(test_cases: T.List[TestCase], stdout, stderr,
+                      test_names_file: str, results_file: str) -> T.List[TestCase]:
+    test_process = test_cases[0].test_process
+    if stdout == subprocess.PIPE:
+        # Read stdout and stderr while the test is running so that it never blocks on a full pipe
+        output, errors = test_process.communicate()
+    else:
+        test_process.wait()
+        output = read_output_file(stdout)
+        errors = read_output_file(stderr)
+    if test_names_file is not None:
+        os.remove(test_names_file)
+    durations = read_durations(results_file)
+    os.remove(results_file)
+    for test_case in test_cases:
+        test_case.output = output
+        test_case.errors = errors
+        test_case.duration = durations.get(test_case.name)
+        if test_case.duration is None:
+            test_case.duration = parse_duration(output, test_case.name)
+    return test_cases
+
+
+def wait_for_finished_tests(running_tests: T.Dict[concurrent.futures.Future, T.List[TestCase]],
+                            test_printer: TestPrinter) -> T.List[T.List[TestCase]]:
+    # Block until at least one test process finishes, refreshing the run status while waiting
+    while True:
+        finished, _ = concurrent.futures.wait(running_tests, timeout=RUN_STATUS_INTERVAL,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+        if finished:
+            break
+        test_printer.print_run_status([test_case for batch in running_tests.values() for test_case in batch])
+    for future in finished:
+        del running_tests[future]
+    return [future.result() for future in finished]
 
 
 @click.command()
@@ -113,10 +342,11 @@ class TestPrinter:
 @click.argument('test_filter', default='')
 @click.option('-v', '--verbose', is_flag=True)
 @click.option('-q', '--quiet', is_flag=True)
-@click.option('-j', '--jobs', default=os.cpu_count() - 1)
+@click.option('-j', '--jobs', default=max(os.cpu_count() - 1, 1), type=click.IntRange(min=1))
 @click.option('-r', '--repeat', default=1)
+@click.option('-b', '--batch-size', default=1, type=click.IntRange(min=1), help='Number of tests run by one test process.')
 @click.option('--log', default="testlog.txt")
-def run_tests(test_exe, test_filter, verbose, quiet, jobs, repeat, log):
+def run_tests(test_exe, test_filter, verbose, quiet, jobs, repeat, batch_size, log):
     test_printer = TestPrinter()
     test_printer.verbose = verbose
     test_printer.quiet = quiet
@@ -126,75 +356,75 @@ def run_tests(test_exe, test_filter, verbose, quiet, jobs, repeat, log):
 
     # Get list of tests
     test_cases_xml = subprocess.run([test_exe, test_filter, '--list-tests',
-                                    '--reporter=xml'], check=True, capture_output=True, text=True).stdout
-    root = et.fromstring(test_cases_xml)
+                                    '--reporter=xml'], check=True, capture_output=True).stdout
     test_cases: T.List[TestCase] = []
-    for child in root:
-        test_case = TestCase(name=child.find("Name").text,
-                             tags=child.find("Tags").text)
+    for _, element in et.iterparse(io.BytesIO(test_cases_xml), events=('end',)):
+        if element.tag != 'TestCase':
+            continue
+        test_case = TestCase(name=element.findtext("Name"),
+                             tags=element.findtext("Tags") or "")
         test_case.name_and_tag = f"\"{test_case.name}\" {test_case.tags}"
         test_cases.append(test_case)
         test_printer.max_test_name_length = max(test_printer.max_test_name_length, len(test_case.name_and_tag))
-        test_printer.test_log = open(log, 'w')
+        element.clear()
+    previous_durations = read_previous_durations(log)
+    # Start the longest tests first so that a slow test does not end up running alone at the end.
+    # Sorted before copying for repeat so that the repeats of a test do not run at the same time.
+    test_cases.sort(key=lambda test_case: -previous_durations.get(test_case.name_and_tag.rstrip(), 0.0))
     # Copy test cases for repeat
-    test_cases_repeat = []
-    for _ in range(repeat):
-        for test_case in test_cases:
-            test_cases_repeat.append(copy.deepcopy(test_case))
-    test_cases = test_cases_repeat
+    test_cases = [TestCase(name=test_case.name, tags=test_case.tags, name_and_tag=test_case.name_and_tag)
+                  for _ in range(repeat) for test_case in test_cases]
     test_printer.test_count = len(test_cases)
+    test_printer.test_count_width = 2*len(str(test_printer.test_count)) + 1
 
     if len(test_cases) == 0:
         sys.exit(f"No matching test cases for \"{test_filter}\"")
-    start_time = time()
+    test_printer.open_log(log)
+    # Close the log also on Ctrl-C or errors so that the lines written so far are not lost
+    try:
+        start_time = time()
 
-    # Run tests in parallel
-    running_tests = []
-    for test_case in test_cases:
-        while len(running_tests) == max_jobs:
-            for running_test in running_tests:
-                status = running_test.test_process.poll()
-                if status != None:
-                    test_printer.print_result(running_test)
-                    running_tests.remove(running_test)
-                    break
-            if len(running_tests) == max_jobs:
-                test_printer.print_run_status(running_tests)
-                sleep(0.2)
-        test_case.test_process = subprocess.Popen([test_exe, test_case.name,
-                                                   '--colour-mode=ansi', '--durations=yes'],
-                                                  stdout=subprocess.PIPE,
-                                                  stderr=subprocess.PIPE, text=True)
-        running_tests.append(test_case)
-    # Wait for remaining jobs
-    while len(running_tests) > 0:
-        test_printer.print_run_status(running_tests)
-        for running_test in running_tests:
-            status = running_test.test_process.poll()
-            if status != None:
-                test_printer.print_result(running_test)
-                running_tests.remove(running_test)
-                break
-            sleep(0.2)
-
-    # Summary
-    test_printer.log('\x1b[K', end="\r")
-    test_printer.log()
-    total_time = time() - start_time
-    test_printer.log(f'Total time: {total_time:.3f}s')
-    test_printer.log(f"{'OK':5} {test_printer.ok_count}")
-    test_printer.log(f"{'FAIL':5} {test_printer.failing_count}")
-    test_printer.log()
-    if test_printer.failing_count == 0:
-        test_printer.log(f"{GREEN}All tests ok{END_COLOR}")
-    else:
-        test_printer.log(f"{RED}Failing test cases:{END_COLOR}")
-        for test_case in test_cases:
-            if test_case.test_process.poll() != 0:
-                test_printer.log(f"\"{test_case.name}\" {test_case.tags}")
+        # Run tests in parallel
+        pending_tests = collections.deque(split_to_batches(test_cases, batch_size))
+        running_tests: T.Dict[concurrent.futures.Future, T.List[TestCase]] = {}
+        failed_batches: T.List[T.List[TestCase]] = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs) as output_readers:
+            while len(pending_tests) > 0 or len(running_tests) > 0:
+                while len(pending_tests) > 0 and len(running_tests) < max_jobs:
+                    batch = pending_tests.popleft()
+                    running_tests[output_readers.submit(run_tests_process, batch, *start_tests(test_exe, batch, quiet))] = batch
+                for batch in wait_for_finished_tests(running_tests, test_printer):
+                    if len(batch) > 1 and batch[0].test_process.returncode != 0:
+                        # Rerun tests of a failing batch one by one to find out which of them failed
+                        test_printer.print_failed_batch(batch)
+                        failed_batches.append(batch)
+                        pending_tests.extendleft([test_case] for test_case in reversed(batch))
+                    else:
+                        test_printer.print_result(batch)
+        for batch in failed_batches:
+            if all(test_case.test_process.returncode == 0 for test_case in batch):
+                test_printer.print_batch_failure(batch)
+
+        # Summary
+        test_printer.log('\x1b[K', end="\r")
+        test_printer.log()
+        total_time = time() - start_time
+        test_printer.log(f'Total time: {total_time:.3f}s')
+        test_printer.log(f"{'OK':5} {test_printer.ok_count}")
+        test_printer.log(f"{'FAIL':5} {test_printer.failing_count}")
+        test_printer.log()
+        if test_printer.failing_count == 0:
+            test_printer.log(f"{GREEN}All tests ok{END_COLOR}")
+        else:
+            test_printer.log(f"{RED}Failing test cases:{END_COLOR}")
+            for failing_test in test_printer.failing_tests:
+                test_printer.log(failing_test)
+    finally:
+        test_printer.close_log()
 
-    print()
-    print(f'Full test log written to {os.path.abspath(log)}')
+    if test_printer.log_error is None:
+        print()
+        print(f'Full test log written to {os.path.abspath(log)}')
     sys.exit(test_printer.failing_count > 0)
 
 